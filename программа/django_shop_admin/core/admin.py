@@ -1,13 +1,18 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.http import HttpResponseRedirect
 from django.contrib.admin.widgets import FilteredSelectMultiple
-from .models import Shop, Category, Product, ProductImage
-from django.db.models import ImageField, Q
+from .models import (Shop, Category, Product, ProductImage, ChangeLog, log_changes,
+	ConcurrentEditError, claim_versions, check_category_graph)
+from django.db.models import ImageField, Q, F, Exists, OuterRef, Subquery
+from django.db.models.functions import Substr
+from django.contrib.admin.views.main import ChangeList
 from django import forms
 from admin_numeric_filter.admin import RangeNumericFilter, NumericFilterModelAdmin
 from django.utils.html import format_html
 from django.urls import path, reverse
 from django.template.response import TemplateResponse
-from django.db import transaction
+from django.db import transaction, router
+from contextlib import ExitStack
 from django.contrib.admin.options import (
 	PermissionDenied, unquote, DisallowedModelAdminToField,
 	flatten_fieldsets, all_valid, IS_POPUP_VAR, TO_FIELD_VAR, 
@@ -18,6 +23,10 @@ from django.forms.models import BaseInlineFormSet
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 from django.template.defaultfilters import truncatechars
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 class ManagedShopsInlineAdmin(admin.TabularInline):
 	model = Shop.product_managers.through
@@ -38,14 +47,58 @@ admin.site.register(User, CustomUserAdmin)
 class ShortDescriptionListFieldMixin:
 	short_description_length = 160
 
+	def with_short_description(self, queryset):
+		# одного лишнего символа достаточно, чтобы truncatechars добавил многоточие
+		return queryset.annotate(
+			short_description_text=Substr('description', 1, self.short_description_length+1))
+
 	def short_description(self, instance):
+		if hasattr(instance, 'short_description_text'):
+			return truncatechars(instance.short_description_text, self.short_description_length)
 		return truncatechars(instance.description, self.short_description_length)
 
 	short_description.short_description = 'Описание'
 
 
+class ListColumnsChangeList(ChangeList):
+	"""Список объектов, загружающий только отображаемые столбцы"""
+
+	def get_queryset(self, request):
+		return self.model_admin.get_list_queryset(super().get_queryset(request))
+
+
+class CachedRowsAdminMixin:
+	"""Примесь администратора, кеширующая отрисованные строки списка объектов.
+	  Строка отрисовывается заново только при изменении версии объекта.
+	"""
+	change_list_template = 'admin/cached_change_list.html'
+	row_cache_timeout = 24*60*60
+
+	def get_changelist(self, request, **kwargs):
+		return ListColumnsChangeList
+
+	def get_list_queryset(self, queryset):
+		return queryset
+
+	def get_row_version(self, obj):
+		"""Возвращает версию строки списка - все загруженные для списка значения объекта"""
+		return repr(sorted((k, v) for k, v in obj.__dict__.items() if not k.startswith('_')))
+
+	def changelist_view(self, request, extra_context=None):
+		# время только текущего потока: process_time учитывал бы другие запросы сервера
+		start = time.thread_time()
+		response = super().changelist_view(request, extra_context)
+		if hasattr(response, 'render'):
+			response.render()
+			cl = response.context_data.get('cl')
+			logger.info('%s changelist: %.1f ms CPU, cached rows %s/%s', self.opts.label_lower,
+				(time.thread_time()-start)*1000, getattr(cl, 'row_cache_hits', 0),
+				len(getattr(cl, 'result_list', ())))
+		return response
+
+
 @admin.register(Shop)
-class ShopAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
+class ShopAdmin(CachedRowsAdminMixin, admin.ModelAdmin, ShortDescriptionListFieldMixin):
 	list_display = ('title','image','id', 'short_description')
 	search_fields = ('title',)
 	ordering = ('title',)
@@ -62,6 +115,9 @@ class ShopAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
 
 	image.short_description = 'Фото'
 
+	def get_list_queryset(self, queryset):
+		return self.with_short_description(queryset.only('id', 'title', 'imageUrl'))
+
 	def get_fields(self, request, obj=None):
 		if request.user.is_superuser:
 			return ('id', 'title', 'description', 'imageUrl', 'product_managers')
@@ -88,6 +144,68 @@ class ShopAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
 			else:
 				return False
 
+class FilteredSelectMultipleWithReadonlyMode(FilteredSelectMultiple):
+	"""Виджет FilteredSelectMultiple, отображаемый только для чтения при атрибуте readonly"""
+
+	def get_context(self, name, value, attrs):
+		context = super().get_context(name, value, attrs)
+		if self.attrs.get('readonly'):
+			context['widget']['attrs']['class'] = context['widget']['attrs'].get('class', '')+' readonly'
+		return context
+
+
+class VersionedModelForm(forms.ModelForm):
+	"""Форма модели с версией объекта для обнаружения одновременных изменений
+
+	  Attributes:
+	    related_ids: ID связанных объектов той же модели, блокируемых вместе с объектом
+	"""
+	loaded_version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+	related_ids = ()
+
+	def __init__(self, *args, **kwargs):
+		super(VersionedModelForm, self).__init__(*args, **kwargs)
+		if self.instance.pk:
+			self.fields['loaded_version'].initial = self.instance.version
+
+	def clean_loaded_version(self):
+		version = self.cleaned_data['loaded_version']
+		if self.instance.pk and version != self.instance.version:
+			self.add_error(None, ConcurrentEditError(self.instance))
+		return version
+
+	def claim_versions(self, obj, change):
+		"""Захватывает версию объекта и блокирует связанные объекты перед их записью"""
+		versions = {obj.pk: self.cleaned_data['loaded_version']} if change else {}
+		claim_versions(type(obj), versions, self.related_ids)
+		if change:
+			obj.version = versions[obj.pk]+1
+
+
+class VersionedAdminMixin:
+	"""Примесь администратора, сохраняющая объекты только если их версия не изменилась.
+	  В отличие от ModelAdmin.changeform_view транзакция открывается не для всего запроса,
+	  а в save_model, после проверки форм: чтения при проверке не удерживают блокировки,
+	  а версии захватываются первым запросом записи (см. команду stresstest).
+	"""
+
+	def save_model(self, request, obj, form, change):
+		write_transaction = getattr(request, 'write_transaction', None)
+		if write_transaction is not None:
+			write_transaction.enter_context(transaction.atomic(using=router.db_for_write(self.model)))
+		form.claim_versions(obj, change)
+		super().save_model(request, obj, form, change)
+
+	def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+		try:
+			# транзакция, открытая в save_model, завершается вместе с запросом
+			with ExitStack() as request.write_transaction:
+				return self._changeform_view(request, object_id, form_url, extra_context)
+		except ConcurrentEditError as e:
+			self.message_user(request, e.message, messages.ERROR)
+			return HttpResponseRedirect(request.get_full_path())
+
+
 class ParentCategoryFilter(admin.SimpleListFilter):
 	title = 'Род. категория'
 	parameter_name = 'parents__id'
@@ -103,7 +221,7 @@ class ParentCategoryFilter(admin.SimpleListFilter):
 		return queryset
 
 
-class CategoryAdminForm(forms.ModelForm):
+class CategoryAdminForm(VersionedModelForm):
 	parents = forms.ModelMultipleChoiceField(label='Родительские категории',
 				queryset = Category.objects.only('title').order_by('title'),
 				required=False,
@@ -128,6 +246,7 @@ class CategoryAdminForm(forms.ModelForm):
 	def __init__(self, *args, **kwargs):
 		super(CategoryAdminForm, self).__init__(*args, **kwargs)
 		instance = kwargs.get("instance")
+		self._initial_ids = {'parents': set(), 'children': set()}
 		if instance and instance.pk:
 			self.fields['parents'].queryset=Category.objects.filter(
 						~(Q(pk=instance.pk)|Q(pk__in=instance.category_set.values('id')))
@@ -138,30 +257,76 @@ class CategoryAdminForm(forms.ModelForm):
 					).only('title').order_by('title')
 			self.fields['children'].initial=instance.category_set.all()
 			self.fields['children'].widget.attrs['readonly']=True
+			self._initial_ids['parents'] = set(instance.parents.values_list('id', flat=True))
+			self._initial_ids['children'] = set(instance.category_set.values_list('id', flat=True))
+
+	def clean(self):
+		cleaned_data = super(CategoryAdminForm, self).clean()
+		if 'parents' in cleaned_data and 'children' in cleaned_data:
+			try:
+				check_category_graph(self.instance.pk, [o.pk for o in cleaned_data['parents']],
+					[o.pk for o in cleaned_data['children']])
+			except forms.ValidationError as e:
+				self.add_error('parents', e)
+			else:
+				# при сохранении граф проверяется одним запросом, а не рекурсивно в сигнале
+				self.instance.parents_checked = True
+				self.related_ids = self._changed_ids('parents', cleaned_data['parents']) \
+					| self._changed_ids('children', cleaned_data['children'])
+		return cleaned_data
 
 	def save(self, commit=True):
 		category = super(CategoryAdminForm, self).save(commit=False)
+		self._change_action = ChangeLog.CREATE if category._state.adding else ChangeLog.UPDATE
 		if commit:
-			error=1
+			self._error_field = None
 			try:
 				with transaction.atomic():
+					self.claim_versions(category, self._change_action == ChangeLog.UPDATE)
 					category.save()
-					data = self.cleaned_data['parents']
-					if self.fields['parents'].has_changed(self.fields['parents'].initial, data):
-						category.parents.set(data)
-					error=2
-					data = self.cleaned_data['children']
-					if self.fields['children'].has_changed(self.fields['children'].initial, data):
-						category.category_set.set(data)
+					self._save_m2m()
 			except forms.ValidationError as e:
-				self.add_error('parents' if error==1 else 'children', e)
+				self.add_error(self._error_field, e)
 			except Exception as e:
 				self.add_error(None, e)
 		return category
 
+	def _save_m2m(self):
+		category = self.instance
+		log_changes(Category, (category.pk,), self._change_action)
+		self._error_field = None
+		parents = self.cleaned_data['parents']
+		children = self.cleaned_data['children']
+		if self.related_ids:
+			# категории, связи которых меняются, уже заблокированы вместе с самой категорией,
+			# поэтому её связи и граф перепроверяются под этими блокировками
+			if set(category.parents.values_list('id', flat=True)) != self._initial_ids['parents'] \
+					or set(category.category_set.values_list('id', flat=True)) != self._initial_ids['children']:
+				raise ConcurrentEditError(category)
+			try:
+				check_category_graph(category.pk, [o.pk for o in parents], [o.pk for o in children])
+			except forms.ValidationError:
+				raise ConcurrentEditError(category)
+		self._error_field = 'parents'
+		if self.fields['parents'].has_changed(self.fields['parents'].initial, parents):
+			category.parents.set(parents)
+		self._error_field = 'children'
+		if self.fields['children'].has_changed(self.fields['children'].initial, children):
+			category.category_set.set(children)
+
+	def _changed_ids(self, field_name, data):
+		"""Возвращает ID категорий, добавленных в поле или удалённых из него"""
+		return self._initial_ids[field_name] ^ {o.pk for o in data}
+
+
+class ProductAdminForm(VersionedModelForm):
+	class Meta:
+		model = Product
+		fields = '__all__'
+
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin)
+class CategoryAdmin(VersionedAdminMixin, admin.ModelAdmin):
 	list_display = ('title','id', 'description', 'category_actions')
 	search_fields = ('products__id', 'title')
 	list_filter = (ParentCategoryFilter,)
@@ -170,7 +335,8 @@ class CategoryAdmin(admin.ModelAdmin)
 	form = CategoryAdminForm
 
 	def get_fields(self, request, obj=None):
-		return ('id', 'title', 'description', 'parents', 'children')
+		return ('id', 'loaded_version', 'title', 'description', 'parents', 'children')
+
 		
 	def get_urls(self):
 		urls = super().get_urls()
@@ -240,29 +406,83 @@ class CategoryFilter(admin.SimpleListFilter):
 		return queryset
 
 
+class ImageSizeFilter(admin.SimpleListFilter):
+	title = 'Размер фото'
+	parameter_name = 'image_size'
+	sizes = ((1, '> 1 МБ'), (5, '> 5 МБ'), (10, '> 10 МБ'))
+
+	def lookups(self, request, model_admin):
+		return self.sizes
+
+	def queryset(self, request, queryset):
+		value = self.value()
+		if value is not None:
+			ids = ProductImage.objects.filter(image_size__gt=int(value)*1024*1024).values('product_id')
+			return queryset.filter(id__in=ids)
+		return queryset
+
+
+class MainImageFilter(admin.SimpleListFilter):
+	title = 'Основное фото'
+	parameter_name = 'main_image'
+	min_side = 600
+
+	def lookups(self, request, model_admin):
+		return (('missing', 'Нет фото'), ('small', f'Меньше {self.min_side} пикс.'),
+			('unscanned', 'Без метаданных'))
+
+	def queryset(self, request, queryset):
+		value = self.value()
+		# подзапросы вместо соединения с фото: без distinct() по набору работают действия, в т.ч. удаление
+		has_images = Exists(ProductImage.objects.filter(product=OuterRef('pk')))
+		if value == 'missing':
+			return queryset.filter(~has_images)
+		if value is not None:
+			main = ProductImage.objects.filter(product=OuterRef('pk')).order_by('id')
+			queryset = queryset.annotate(
+				main_image_width=Subquery(main.values('image_width')[:1]),
+				main_image_height=Subquery(main.values('image_height')[:1]),
+			)
+			if value == 'small':
+				return queryset.filter(Q(main_image_width__lt=self.min_side)|Q(main_image_height__lt=self.min_side))
+			if value == 'unscanned':
+				return queryset.filter(has_images, main_image_width__isnull=True)
+		return queryset
+
+
 @admin.register(Product)
-class ProductAdmin(NumericFilterModelAdmin):
+class ProductAdmin(CachedRowsAdminMixin, VersionedAdminMixin, NumericFilterModelAdmin):
 	list_display = ('title','main_image', 'id', 'amount', 'price', 'active', 'shop_id')
-	fieldsets = ((None, {'fields':('id', 'shop', 'title', 'description', 'active', 'amount', 'price')}),
+	fieldsets = ((None, {'fields':('id', 'loaded_version', 'shop', 'title', 'description', 'active', 'amount', 'price')}),
 		('КАТЕГОРИИ', {'fields': ('categories',), 'classes': ('collapse',)}),
 		('ОСНОВНОЕ ФОТО', {'fields': ('main_image',)}),
 		)
 	search_fields = ('id', 'title')
-	list_filter = ('active',CategoryFilter,ShopFilter)
-	readonly_fields = ('id',)
+	list_filter = ('active',CategoryFilter,ShopFilter,MainImageFilter,ImageSizeFilter)
+	readonly_fields = ('id', 'main_image')
 	filter_horizontal = ('categories',)
 	actions = ('make_active', 'make_inactive')
 	list_per_page = 50
+	form = ProductAdminForm
 	
 	class Media:
 		css = {'all': ('css/productlist.css',)}
 
 
+	def get_list_queryset(self, queryset):
+		main = ProductImage.objects.filter(product=OuterRef('pk')).order_by('id')
+		return queryset.only('id', 'version', 'shop', 'title', 'amount', 'price', 'active').annotate(
+			main_image_name=Subquery(main.values('image')[:1]))
+
 	def main_image(self, instance):
-		url = instance.images.only('image').first()
+		if hasattr(instance, 'main_image_name'):
+			url = instance.main_image_name
+		else:
+			url = instance.images.only('image').first()
+			url = url and url.image
 		if url:
 			return format_html("<img src='{}{}' width=100 height=100 style='object-fit:contain' />",
-				settings.MEDIA_URL, url.image)
+				settings.MEDIA_URL, url)
 		else:
 			return format_html("<img alt='—' />")
 
@@ -290,10 +510,33 @@ class ProductAdmin(NumericFilterModelAdmin):
 		else:
 			return qs.filter(shop__id__in=request.user.managed_shops.values_list('id', flat=True))
 			
+
+	def save_model(self, request, obj, form, change):
+		super().save_model(request, obj, form, change)
+		log_changes(Product, (obj.pk,), ChangeLog.UPDATE if change else ChangeLog.CREATE)
+
+	def delete_model(self, request, obj):
+		with transaction.atomic():
+			log_changes(Product, (obj.pk,), ChangeLog.DELETE)
+			super().delete_model(request, obj)
+
+	def delete_queryset(self, request, queryset):
+		with transaction.atomic():
+			log_changes(Product, queryset.values_list('id', flat=True), ChangeLog.DELETE)
+			super().delete_queryset(request, queryset)
+
+	def set_active(self, queryset, active):
+		"""Изменяет активность продуктов и записывает изменения в журнал"""
+		with transaction.atomic():
+			ids = list(queryset.exclude(active=active).values_list('id', flat=True))
+			Product.objects.filter(id__in=ids).update(active=active, version=F('version')+1)
+			log_changes(Product, ids, ChangeLog.UPDATE)
+			
 	@admin.action(description='Сделать активными')
 	def make_active(self, request, queryset):
-		queryset.update(active=True)
+		self.set_active(queryset, True)
 
 	@admin.action(description='Сделать неактивными')
 	def make_inactive(self, request, queryset):
-		queryset.update(active=False)
+		self.set_active(queryset, False)
+
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.snapshots import build_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Строит снимки каталогов магазинов для витрины.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.CATALOG_SNAPSHOTS_DIR,
+            help='Каталог для файлов снимков')
+        parser.add_argument('--full', action='store_true',
+            help='Пересобрать снимки всех магазинов')
+        parser.add_argument('--workers', type=int, default=None,
+            help='Количество процессов')
+
+    def handle(self, *args, **options):
+    	built = build_snapshots(options['output'], full=options['full'], workers=options['workers'])
+    	for shop_id, count in sorted(built.items()):
+    		self.stdout.write(f" - магазин {shop_id}: {count}")
+    	self.stdout.write(f"Пересобрано снимков: {len(built)}")
@@ -0,0 +1,28 @@
+import json
+from django.core.management.base import BaseCommand
+from core.models import ChangeLog
+
+
+class Command(BaseCommand):
+    help = 'Выводит записи журнала изменений после указанного курсора в формате JSONL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cursor', type=int, default=0,
+            help='ID последней обработанной записи журнала')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Количество записей, читаемых из БД за один запрос')
+
+    def handle(self, *args, **options):
+    	cursor = options['cursor']
+    	batch_size = options['batch_size']
+    	fields = ('id', 'model_name', 'object_id', 'action', 'created')
+    	while True:
+    		batch = list(ChangeLog.objects.filter(id__gt=cursor).order_by('id').values_list(*fields)[:batch_size])
+    		for row in batch:
+    			record = dict(zip(fields, row))
+    			record['created'] = record['created'].isoformat()
+    			self.stdout.write(json.dumps(record, ensure_ascii=False))
+    		if len(batch) < batch_size:
+    			break
+    		cursor = batch[-1][0]
+    	self.stderr.write(f"cursor: {batch[-1][0] if batch else cursor}")
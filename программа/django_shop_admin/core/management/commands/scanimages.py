@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from core.models import Shop, ProductImage, IMAGE_METADATA_FIELDS, read_image_metadata
+
+
+class Command(BaseCommand):
+    help = 'Заполняет метаданные (размеры, формат, объём, хеш) существующих изображений.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+            help='Количество потоков чтения файлов')
+        parser.add_argument('--batch-size', type=int, default=200,
+            help='Количество объектов, обрабатываемых за один запрос к БД')
+        parser.add_argument('--all', action='store_true',
+            help='Пересчитать метаданные всех изображений, а не только незаполненные')
+
+    def handle(self, *args, **options):
+    	with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+    		for model, field in ((Shop, 'imageUrl'), (ProductImage, 'image')):
+    			scanned, failed = self.scan(pool, model, field, options)
+    			self.stdout.write(f" - {model._meta.verbose_name_plural}: обработано {scanned}, ошибок {failed}")
+
+    def scan(self, pool, model, field, options):
+    	qs = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+    	if not options['all']:
+    		qs = qs.filter(image_hash__isnull=True)
+    	qs = qs.only('pk', field).order_by('pk')
+    	scanned = failed = last = 0
+    	while True:
+    		objs = list(qs.filter(pk__gt=last)[:options['batch_size']])
+    		if not objs:
+    			return scanned, failed
+    		last = objs[-1].pk
+    		updated = []
+    		for obj, values in zip(objs, pool.map(lambda o: self.read(getattr(o, field)), objs)):
+    			if values is None:
+    				failed += 1
+    				continue
+    			for k, v in values.items():
+    				setattr(obj, k, v)
+    			updated.append(obj)
+    		model.objects.bulk_update(updated, IMAGE_METADATA_FIELDS)
+    		scanned += len(updated)
+
+    def read(self, file):
+    	try:
+    		with file.storage.open(file.name, 'rb') as f:
+    			return read_image_metadata(f)
+    	except Exception as e:
+    		# повреждённый или слишком большой файл не должен останавливать обработку
+    		# остальных (DecompressionBombError и часть ошибок декодеров - не OSError)
+    		self.stderr.write(f"{file.name}: {e!r}")
+    		return None
@@ -0,0 +1,183 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from django.contrib import admin
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction, OperationalError
+from django.forms.forms import NON_FIELD_ERRORS
+from core.admin import CategoryAdminForm, ProductAdminForm
+from core.models import Shop, Category, CategoryParent, Product, ConcurrentEditError
+
+STATS = ('commits', 'conflicts', 'rejected', 'errors', 'validate', 'write', 'lock_wait', 'lock_hold')
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочная проверка одновременного изменения категорий и продуктов через формы администратора. '\
+        'Выполняется во временной базе данных.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8,
+            help='Количество потоков, изменяющих категории')
+        parser.add_argument('--product-threads', type=int, default=4,
+            help='Количество потоков, изменяющих продукты')
+        parser.add_argument('--iterations', type=int, default=50,
+            help='Количество изменений в каждом потоке')
+        parser.add_argument('--rows', type=int, default=8,
+            help='Количество изменяемых категорий')
+        parser.add_argument('--products', type=int, default=8,
+            help='Количество изменяемых продуктов')
+        parser.add_argument('--think', type=float, default=0.005,
+            help='Время между открытием формы и её отправкой, с')
+        parser.add_argument('--validate-inside-transaction', action='store_true',
+            help='Проверять форму внутри транзакции записи, как ModelAdmin.changeform_view, '
+                'а не до неё, как VersionedAdminMixin')
+
+    def handle(self, *args, **options):
+    	# записи журнала изменений и связи категорий остаются во временной базе, а не в рабочей
+    	db = connections[DEFAULT_DB_ALIAS]
+    	old_name = db.settings_dict['NAME']
+    	old_test_name = db.settings_dict['TEST'].get('NAME')
+    	with tempfile.TemporaryDirectory() as directory:
+    		if db.vendor == 'sqlite':
+    			# общая память SQLite блокирует таблицы иначе, чем файл
+    			db.settings_dict['TEST']['NAME'] = os.path.join(directory, 'stresstest.sqlite3')
+    		db.creation.create_test_db(verbosity=0, autoclobber=True)
+    		try:
+    			self.run(options)
+    		finally:
+    			db.creation.destroy_test_db(old_name, verbosity=0)
+    			db.settings_dict['TEST']['NAME'] = old_test_name
+
+    def run(self, options):
+    	category_ids = [Category.objects.create(title=f'stress-{uuid.uuid4().hex}').pk
+    		for _ in range(options['rows'])]
+    	shop = Shop.objects.create(title=f'stress-{uuid.uuid4().hex}')
+    	product_ids = [Product.objects.create(shop=shop, title=f'stress-{uuid.uuid4().hex}', price=1).pk
+    		for _ in range(options['products'])]
+    	stats = {Category: dict.fromkeys(STATS, 0), Product: dict.fromkeys(STATS, 0)}
+    	lock = threading.Lock()
+
+    	def submit(model, form_class, pk, data):
+    		"""Отправляет данные формы так же, как ModelAdmin._changeform_view"""
+    		model_admin = admin.site._registry[model]
+    		time.sleep(options['think'])
+    		if not options['validate_inside_transaction']:
+    			start = time.perf_counter()
+    			form = form_class(data, instance=model.objects.get(pk=pk))
+    			valid = form.is_valid()
+    			validated = time.perf_counter()
+    		with transaction.atomic():
+    			if options['validate_inside_transaction']:
+    				start = time.perf_counter()
+    				form = form_class(data, instance=model.objects.get(pk=pk))
+    				valid = form.is_valid()
+    				validated = time.perf_counter()
+    			if not valid:
+    				return ('conflicts' if form.has_error(NON_FIELD_ERRORS) else 'rejected'), {}
+    			# захват версии - первая запись транзакции, на ней и ожидается блокировка БД
+    			claim = form.claim_versions
+    			claimed = {}
+
+    			def timed_claim(obj, change):
+    				claimed['start'] = time.perf_counter()
+    				claim(obj, change)
+    				claimed['end'] = time.perf_counter()
+    			form.claim_versions = timed_claim
+    			# порядок вызовов ModelAdmin._changeform_view; транзакция открыта здесь, а не в save_model
+    			new_object = model_admin.save_form(None, form, True)
+    			model_admin.save_model(None, new_object, form, True)
+    			model_admin.save_related(None, form, [], True)
+    		committed = time.perf_counter()
+    		return 'commits', {'validate': validated-start, 'write': committed-validated,
+    			'lock_wait': claimed['end']-claimed['start'], 'lock_hold': committed-claimed['end']}
+
+    	def edit_category(i):
+    		"""Открывает форму случайной категории и отправляет изменённые связи"""
+    		pk = random.choice(category_ids)
+    		obj = Category.objects.get(pk=pk)
+    		others = [x for x in category_ids if x != pk]
+    		children = set(obj.category_set.values_list('id', flat=True))
+    		parents = random.sample([x for x in others if x not in children], random.randint(0, 2))
+    		current_parents = set(obj.parents.values_list('id', flat=True))
+    		children = random.sample([x for x in others if x not in current_parents and x not in parents],
+    			random.randint(0, 2))
+    		return submit(Category, CategoryAdminForm, pk, {'title': obj.title, 'description': str(i),
+    			'loaded_version': obj.version, 'parents': parents, 'children': children})
+
+    	def edit_product(i):
+    		"""Открывает форму случайного продукта и отправляет изменённые количество и категории"""
+    		pk = random.choice(product_ids)
+    		obj = Product.objects.get(pk=pk)
+    		return submit(Product, ProductAdminForm, pk, {'shop': obj.shop_id, 'title': obj.title,
+    			'description': str(i), 'active': obj.active, 'amount': random.randint(0, 100),
+    			'price': obj.price, 'categories': random.sample(category_ids, random.randint(0, 2)),
+    			'loaded_version': obj.version})
+
+    	def worker(model, edit):
+    		local = dict.fromkeys(STATS, 0)
+    		try:
+    			for i in range(options['iterations']):
+    				try:
+    					result, times = edit(i)
+    				except ConcurrentEditError:
+    					result, times = 'conflicts', {}
+    				except OperationalError:
+    					result, times = 'errors', {}
+    				local[result] += 1
+    				for k, v in times.items():
+    					local[k] += v
+    		finally:
+    			connection.close()
+    			with lock:
+    				for k, v in local.items():
+    					stats[model][k] += v
+
+    	threads = [threading.Thread(target=worker, args=(Category, edit_category))
+    		for _ in range(options['threads'])]
+    	threads += [threading.Thread(target=worker, args=(Product, edit_product))
+    		for _ in range(options['product_threads'])]
+    	start = time.perf_counter()
+    	for t in threads:
+    		t.start()
+    	for t in threads:
+    		t.join()
+    	elapsed = time.perf_counter()-start
+    	self.stdout.write(f" - потоков: {options['threads']} для категорий ({options['rows']} шт.), "\
+    		f"{options['product_threads']} для продуктов ({options['products']} шт.), "\
+    		f"проверка {'внутри' if options['validate_inside_transaction'] else 'вне'} транзакции")
+    	self.stdout.write(f" - время: {elapsed:.2f} с")
+    	for model, s in stats.items():
+    		attempts = sum(s[k] for k in ('commits', 'conflicts', 'rejected', 'errors'))
+    		commits = max(s['commits'], 1)
+    		self.stdout.write(f" - {model._meta.verbose_name_plural}: попыток {attempts}, "\
+    			f"пропускная способность {s['commits']/elapsed:.1f} изм./с")
+    		self.stdout.write(f"   конфликты: {s['conflicts']} ({s['conflicts']/max(attempts, 1):.1%}), "\
+    			f"отклонено проверкой: {s['rejected']}, ошибки блокировки: {s['errors']}")
+    		self.stdout.write(f"   в среднем на изменение: проверка {s['validate']/commits*1000:.2f} мс, "\
+    			f"запись {s['write']/commits*1000:.2f} мс, "\
+    			f"ожидание первой записи {s['lock_wait']/commits*1000:.2f} мс, "\
+    			f"удержание блокировки {s['lock_hold']/commits*1000:.2f} мс")
+    	self.stdout.write(f" - циклов в графе категорий: {self.count_cycles(category_ids)}")
+
+    def count_cycles(self, ids):
+    	"""Возвращает количество категорий, входящих в цикл родительских связей"""
+    	parents = {}
+    	for from_id, to_id in CategoryParent.objects.filter(from_category_id__in=ids) \
+    			.values_list('from_category_id', 'to_category_id'):
+    		parents.setdefault(from_id, set()).add(to_id)
+    	count = 0
+    	for pk in ids:
+    		checked = set()
+    		stack = list(parents.get(pk, ()))
+    		while stack:
+    			current = stack.pop()
+    			if current == pk:
+    				count += 1
+    				break
+    			if current not in checked:
+    				checked.add(current)
+    				stack.extend(parents.get(current, ()))
+    	return count
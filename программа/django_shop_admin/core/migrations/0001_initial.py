@@ -0,0 +1,123 @@
+# Generated by Django 4.2.30 on 2026-10-19 18:50
+
+import core.models
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=50, unique=True, verbose_name='Название')),
+                ('description', models.TextField(blank=True, null=True, verbose_name='Описание')),
+            ],
+            options={
+                'verbose_name': 'Категория',
+                'verbose_name_plural': 'Категории',
+                'db_table': 'categories',
+            },
+        ),
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=200, verbose_name='Название')),
+                ('description', models.TextField(blank=True, null=True, verbose_name='Описание')),
+                ('active', models.BooleanField(default=True, verbose_name='Активен')),
+                ('amount', models.PositiveIntegerField(default=0, verbose_name='Количество')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=12, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Цена')),
+                ('categories', models.ManyToManyField(blank=True, related_name='products', to='core.category', verbose_name='Категории')),
+            ],
+            options={
+                'verbose_name': 'Продукт',
+                'verbose_name_plural': 'Продукты',
+                'db_table': 'products',
+            },
+        ),
+        migrations.CreateModel(
+            name='Shop',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=50, unique=True, verbose_name='Название')),
+                ('description', models.TextField(blank=True, null=True, verbose_name='Описание')),
+                ('imageUrl', models.ImageField(blank=True, null=True, unique=True, upload_to=core.models.shop_image_path_handler, verbose_name='Фото')),
+                ('product_managers', models.ManyToManyField(blank=True, limit_choices_to=models.Q(('groups__name', 'product managers')), related_name='managed_shops', to=settings.AUTH_USER_MODEL, verbose_name='Менеджеры продуктов')),
+            ],
+            options={
+                'verbose_name': 'Магазин',
+                'verbose_name_plural': 'Магазины',
+                'db_table': 'shops',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', models.ImageField(unique=True, upload_to=core.models.product_image_path_handler, verbose_name='Фото')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='images', to='core.product', verbose_name='Продукт')),
+            ],
+            options={
+                'verbose_name': 'Фото продукта',
+                'verbose_name_plural': 'Фото продукта',
+                'db_table': 'productimages',
+            },
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='shop',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='products', to='core.shop', verbose_name='Магазин'),
+        ),
+        migrations.CreateModel(
+            name='CategoryParent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.category', verbose_name='Дочерняя категория')),
+                ('to_category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='from_category', to='core.category', verbose_name='Родительская категория')),
+            ],
+            options={
+                'verbose_name': 'Отношение категорий',
+                'verbose_name_plural': 'Отношения категорий',
+            },
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='parents',
+            field=models.ManyToManyField(blank=True, through='core.CategoryParent', to='core.category', verbose_name='Родительские категории'),
+        ),
+        migrations.AddConstraint(
+            model_name='shop',
+            constraint=models.CheckConstraint(check=models.Q(('title__iregex', '^\\S.*\\S$')), name='shop_title_check'),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.CheckConstraint(check=models.Q(('title__iregex', '^\\S.*\\S$')), name='product_title_check'),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.CheckConstraint(check=models.Q(('price__gte', 0)), name='product_price_check'),
+        ),
+        migrations.AddConstraint(
+            model_name='categoryparent',
+            constraint=models.UniqueConstraint(fields=('from_category', 'to_category'), name='unique_category_parent'),
+        ),
+        migrations.AddConstraint(
+            model_name='categoryparent',
+            constraint=models.CheckConstraint(check=models.Q(('from_category', models.F('to_category')), _negated=True), name='self_parent_category_check'),
+        ),
+        migrations.AddConstraint(
+            model_name='category',
+            constraint=models.CheckConstraint(check=models.Q(('title__iregex', '^\\S.*\\S$')), name='category_title_check'),
+        ),
+    ]
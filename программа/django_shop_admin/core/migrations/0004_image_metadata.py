@@ -0,0 +1,75 @@
+# Generated by Django 4.2.30 on 2026-10-19 18:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='image_format',
+            field=models.CharField(blank=True, editable=False, max_length=10, null=True, verbose_name='Формат фото'),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Хеш фото'),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Высота фото'),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='image_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True, verbose_name='Размер файла фото'),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Ширина фото'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='image_format',
+            field=models.CharField(blank=True, editable=False, max_length=10, null=True, verbose_name='Формат фото'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Хеш фото'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Высота фото'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='image_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True, verbose_name='Размер файла фото'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Ширина фото'),
+        ),
+        migrations.AddIndex(
+            model_name='productimage',
+            index=models.Index(fields=['product', 'id', 'image_width', 'image_height'], name='productimage_main_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productimage',
+            index=models.Index(fields=['image_size'], name='productimage_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productimage',
+            index=models.Index(fields=['image_hash'], name='productimage_hash_idx'),
+        ),
+    ]
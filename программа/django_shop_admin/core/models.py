@@ -1,16 +1,56 @@
 from django.db.models import (Model, CharField, TextField, ImageField, 
 	BooleanField, PositiveIntegerField, DecimalField, ForeignKey, ManyToManyField,
-	CASCADE, CheckConstraint, UniqueConstraint, Q, F)
+	DateTimeField, PositiveBigIntegerField, CASCADE, CheckConstraint, UniqueConstraint, Index, Q, F)
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, router, connections
 from django.core.exceptions import ValidationError
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, pre_delete, post_save, post_delete
 import uuid
+import hashlib
+from PIL import Image as PILImage
 from django.core.validators import MinValueValidator
 from django.contrib.auth.models import User
 
 # Create your models here.
 
+IMAGE_METADATA_FIELDS = ('image_width', 'image_height', 'image_size', 'image_format', 'image_hash')
+
+def read_image_metadata(file):
+	"""Читает размеры, формат, объём и хеш содержимого изображения.
+	  Args:
+	    file: открытый файл изображения
+	  Returns:
+	  	dict: значения полей метаданных изображения
+	"""
+	file.seek(0)
+	digest = hashlib.sha256()
+	size = 0
+	for chunk in iter(lambda: file.read(64*1024), b''):
+		digest.update(chunk)
+		size += len(chunk)
+	file.seek(0)
+	with PILImage.open(file) as img:
+		width, height = img.size
+		image_format = img.format
+	file.seek(0)
+	return dict(zip(IMAGE_METADATA_FIELDS, (width, height, size, image_format, digest.hexdigest())))
+
+def update_image_metadata(instance, file):
+	"""Заполняет поля метаданных изображения объекта, если файл был загружен или удалён.
+	  Args:
+	    instance: объект модели с полями метаданных изображения
+	    file: файл изображения объекта
+	  Returns:
+	"""
+	if not file:
+		values = dict.fromkeys(IMAGE_METADATA_FIELDS)
+	elif not file._committed:
+		values = read_image_metadata(file)
+	else:
+		return
+	for k, v in values.items():
+		setattr(instance, k, v)
+
 def shop_image_path_handler(instance, filename):
 	"""Генерирует и возвращет путь к файлу изображения магазина.
 	  Args:
@@ -29,6 +69,10 @@ class Shop(Model):
 	    description: описание
 	    imageUrl: путь к изображению
 	    product_managers: менеджеры
+	    image_width, image_height: размеры изображения в пикселях
+	    image_size: размер файла изображения в байтах
+	    image_format: формат изображения
+	    image_hash: SHA-256 содержимого файла изображения
 	"""
 	title = CharField(verbose_name='Название', max_length=50, unique=True)
 	description = TextField(verbose_name='Описание', null=True, blank=True)
@@ -36,10 +80,19 @@ class Shop(Model):
 		upload_to=shop_image_path_handler, unique=True)
 	product_managers = ManyToManyField(User, limit_choices_to=Q(groups__name='product managers'),
 		related_name='managed_shops', verbose_name='Менеджеры продуктов', blank=True)
+	image_width = PositiveIntegerField(verbose_name='Ширина фото', null=True, blank=True, editable=False)
+	image_height = PositiveIntegerField(verbose_name='Высота фото', null=True, blank=True, editable=False)
+	image_size = PositiveBigIntegerField(verbose_name='Размер файла фото', null=True, blank=True, editable=False)
+	image_format = CharField(verbose_name='Формат фото', max_length=10, null=True, blank=True, editable=False)
+	image_hash = CharField(verbose_name='Хеш фото', max_length=64, null=True, blank=True, editable=False)
 
 	def __str__(self):
 		return self.title
 
+	def save(self, *args, **kwargs):
+		update_image_metadata(self, self.imageUrl)
+		super(Shop, self).save(*args, **kwargs)
+
 	class Meta:
 		"""Локальный класс настроек модели
 
@@ -63,11 +116,13 @@ class Category(Model):
 	    title: название
 	    description: описание
 	    parents: родительские категории
+	    version: версия для обнаружения одновременных изменений
 	"""
 	title = CharField(verbose_name='Название', max_length=50, unique=True)
 	description = TextField(verbose_name='Описание', null=True, blank=True)
 	parents = ManyToManyField('self', symmetrical=False, through='CategoryParent', 
 		blank=True, verbose_name='Родительские категории')
+	version = PositiveIntegerField(verbose_name='Версия', default=0, editable=False)
 
 	def __str__(self):
 		return self.title
@@ -142,6 +197,7 @@ class CategoryParent(Model):
 		"""
 		check_child_in_parents(self.from_category_id, self.to_category_id, self.to_category_id)
 		super(CategoryParent, self).save(*args, **kwargs)
+		log_changes(Category, (self.from_category_id, self.to_category_id), ChangeLog.UPDATE)
 		
 
 def check_child_in_parents(from_id, to_id, start_to, checked=set()):
@@ -165,6 +221,36 @@ def check_child_in_parents(from_id, to_id, start_to, checked=set()):
 				check_child_in_parents(from_id, i, start_to, checked)
 
 
+def check_category_graph(category_id, parent_ids, child_ids):
+	"""Проверяет, что новые родительские и дочерние категории не образуют цикл.
+	  Граф отношений читается одним запросом и проверяется в памяти.
+
+	  Args:
+	    category_id: ID категории (None для новой)
+	    parent_ids: ID новых родительских категорий
+	    child_ids: ID новых дочерних категорий
+	  Returns:
+	"""
+	parents = {}
+	for from_id, to_id in CategoryParent.objects.values_list('from_category_id', 'to_category_id'):
+		if from_id != category_id and to_id != category_id:
+			parents.setdefault(from_id, set()).add(to_id)
+	parents[category_id] = set(parent_ids)
+	for i in child_ids:
+		parents.setdefault(i, set()).add(category_id)
+	# любой новый цикл проходит через изменяемую категорию
+	checked = set()
+	stack = [(i, i) for i in parent_ids]
+	while stack:
+		start, current = stack.pop()
+		if current == category_id:
+			raise ValidationError(f'Категория {Category.objects.get(pk=start).title} не может быть '\
+				'родительской, так как является дочерней для данной категории.')
+		if current not in checked:
+			checked.add(current)
+			stack.extend((start, i) for i in parents.get(current, ()))
+
+
 def process_m2m_category_update(sender, instance, action, reverse, pk_set, **kwargs):
 	"""Запускает проверку наличия дочерней категории в списке родительских при изменении списка родительских категорий
       
@@ -176,18 +262,153 @@ def process_m2m_category_update(sender, instance, action, reverse, pk_set, **kwa
         pk_set: множество первичных ключей новых родительских категорий
       Returns:
 	"""
-	if action == 'pre_add':
+	if action == 'pre_add' and not getattr(instance, 'parents_checked', False):
 		if reverse:
 			for k in pk_set:
 				check_child_in_parents(k, instance.pk, instance.pk)
 		else:
 			for k in pk_set:
 				check_child_in_parents(instance.pk, k, k)
-	
+	elif action in ('post_add', 'post_remove'):
+		log_changes(Category, {instance.pk, *pk_set}, ChangeLog.UPDATE)
+	elif action == 'pre_clear':
+		if reverse:
+			ids = CategoryParent.objects.filter(to_category=instance).values_list('from_category_id', flat=True)
+		else:
+			ids = CategoryParent.objects.filter(from_category=instance).values_list('to_category_id', flat=True)
+		log_changes(Category, {instance.pk, *ids}, ChangeLog.UPDATE)
+
 
 m2m_changed.connect(process_m2m_category_update, sender=CategoryParent)
 
 
+def process_category_delete(sender, instance, **kwargs):
+	"""Записывает в журнал удаление категории и изменение её дочерних категорий и продуктов
+
+	  Args:
+	    sender: отправитель сигнала
+	    instance: удаляемая категория
+	  Returns:
+	"""
+	log_changes(Category, CategoryParent.objects.filter(to_category=instance)
+		.values_list('from_category_id', flat=True), ChangeLog.UPDATE)
+	log_changes(Product, instance.products.values_list('id', flat=True), ChangeLog.UPDATE)
+	log_changes(Category, (instance.pk,), ChangeLog.DELETE)
+
+
+pre_delete.connect(process_category_delete, sender=Category)
+
+
+class ConcurrentEditError(ValidationError):
+	"""Исключение, возникающее при изменении объекта, уже изменённого другим пользователем"""
+
+	def __init__(self, instance):
+		super().__init__(f'Объект «{instance}» ({instance._meta.verbose_name}) был изменён '\
+			'другим пользователем. Обновите страницу и повторите изменения.')
+
+
+def claim_versions(model, versions, locked_ids=()):
+	"""Увеличивает версии объектов, если они не изменились с момента чтения,
+	  и блокирует связанные объекты, не меняя их версий.
+	  Должна вызываться в транзакции, в которой затем изменяются эти объекты.
+
+	  Args:
+	    model: класс модели с полем version
+	    versions: словарь версий, которые видел пользователь, по ID объектов
+	    locked_ids: ID объектов, которые нужно только заблокировать
+	  Returns:
+	"""
+	if not connections[router.db_for_write(model)].features.has_select_for_update:
+		# без блокировки строк (SQLite) запись и так блокирует всю БД, а чтение
+		# до первой записи только приводит к ошибке "database is locked"
+		locked_ids = ()
+	# единый порядок захвата исключает взаимную блокировку транзакций
+	for pk in sorted(set(versions) | set(locked_ids)):
+		if pk not in versions:
+			list(model.objects.select_for_update().filter(pk=pk).values_list('pk', flat=True))
+		elif not model.objects.filter(pk=pk, version=versions[pk]).update(version=F('version')+1):
+			raise ConcurrentEditError(model.objects.filter(pk=pk).first() or model(pk=pk))
+
+
+class Product(Model):
+	"""Класс модели продукта
+
+	  Attributes:
+	    shop: магазин
+	    title: название
+	    description: описание
+	    active: активен ли продукт
+	    amount: количество
+	    price: цена
+	    categories: категории
+	    version: версия для обнаружения одновременных изменений
+	"""
+	shop = ForeignKey(Shop, on_delete=CASCADE, verbose_name='Магазин', related_name='products')
+	title = CharField(verbose_name='Название', max_length=200)
+	description = TextField(verbose_name='Описание', null=True, blank=True)
+	active = BooleanField(verbose_name='Активен', default=True)
+	amount = PositiveIntegerField(verbose_name='Количество', default=0)
+	price = DecimalField(verbose_name='Цена', max_digits=12, decimal_places=2,
+		validators=[MinValueValidator(0)])
+	categories = ManyToManyField(Category, related_name='products', blank=True, verbose_name='Категории')
+	version = PositiveIntegerField(verbose_name='Версия', default=0, editable=False)
+
+	def __str__(self):
+		return self.title
+
+	class Meta:
+		"""Локальный класс настроек модели
+
+		  Attributes:
+		    db_table: название таблицы модели в БД
+		    verbose_name: наименование одного объекта модели
+		    verbose_name_plural: множественное число наименования модели
+		    constraints: ограничения таблицы БД
+		"""
+		db_table = 'products'
+		verbose_name = "Продукт"
+		verbose_name_plural = "Продукты"
+		constraints = (
+				CheckConstraint(check=Q(title__iregex=r'^\S.*\S$'), name='product_title_check'),
+				CheckConstraint(check=Q(price__gte=0), name='product_price_check'),
+		)
+
+
+def process_m2m_product_categories_update(sender, instance, action, reverse, pk_set, **kwargs):
+	"""Записывает в журнал изменение списка категорий продуктов
+
+	  Args:
+	    sender: отправитель сигнала
+	    instance: экземпляр модели продукта или категории
+	    action: тип сигнала
+	    reverse: сигнал для категории, а не для продукта
+	    pk_set: множество первичных ключей добавленных или удалённых объектов
+	  Returns:
+	"""
+	if action in ('post_add', 'post_remove'):
+		log_changes(Product, pk_set if reverse else (instance.pk,), ChangeLog.UPDATE)
+	elif action == 'pre_clear':
+		log_changes(Product, instance.products.values_list('id', flat=True) if reverse else (instance.pk,),
+			ChangeLog.UPDATE)
+
+
+m2m_changed.connect(process_m2m_product_categories_update, sender=Product.categories.through)
+
+
+def process_shop_delete(sender, instance, **kwargs):
+	"""Записывает в журнал удаление продуктов удаляемого магазина
+
+	  Args:
+	    sender: отправитель сигнала
+	    instance: удаляемый магазин
+	  Returns:
+	"""
+	log_changes(Product, instance.products.values_list('id', flat=True), ChangeLog.DELETE)
+
+
+pre_delete.connect(process_shop_delete, sender=Shop)
+
+
 def product_image_path_handler(instance, filename):
 	"""Генерирует и возвращет путь к файлу изображения продукта.
 	  Args:
@@ -204,9 +425,22 @@ class ProductImage(Model):
 	  Attributes:
        image: путь к файлу изображения
        product: продукт
+       image_width, image_height: размеры изображения в пикселях
+       image_size: размер файла изображения в байтах
+       image_format: формат изображения
+       image_hash: SHA-256 содержимого файла изображения
 	"""
 	image = ImageField(verbose_name='Фото', unique=True, upload_to=product_image_path_handler)
 	product = ForeignKey(Product, on_delete=CASCADE, verbose_name='Продукт', related_name='images')
+	image_width = PositiveIntegerField(verbose_name='Ширина фото', null=True, blank=True, editable=False)
+	image_height = PositiveIntegerField(verbose_name='Высота фото', null=True, blank=True, editable=False)
+	image_size = PositiveBigIntegerField(verbose_name='Размер файла фото', null=True, blank=True, editable=False)
+	image_format = CharField(verbose_name='Формат фото', max_length=10, null=True, blank=True, editable=False)
+	image_hash = CharField(verbose_name='Хеш фото', max_length=64, null=True, blank=True, editable=False)
+
+	def save(self, *args, **kwargs):
+		update_image_metadata(self, self.image)
+		super(ProductImage, self).save(*args, **kwargs)
 
 	class Meta:
 		"""Локальный класс настроек модели
@@ -215,10 +449,86 @@ class ProductImage(Model):
 		    db_table: название таблицы модели в БД
 		    verbose_name: наименование одного объекта модели
 		    verbose_name_plural: множественное число наименования модели
+		    indexes: индексы таблицы БД
 		"""
 		db_table = 'productimages'
 		verbose_name = 'Фото продукта'
 		verbose_name_plural = 'Фото продукта'
-		
+		indexes = (
+				Index(fields=('product', 'id', 'image_width', 'image_height'), name='productimage_main_idx'),
+				Index(fields=('image_size',), name='productimage_size_idx'),
+				Index(fields=('image_hash',), name='productimage_hash_idx'),
+		)
 
 
+def process_product_image_update(sender, instance, **kwargs):
+	"""Записывает в журнал изменение продукта при добавлении, изменении или удалении его фото
+
+	  Args:
+	    sender: отправитель сигнала
+	    instance: экземпляр модели фото продукта
+	    origin: объект, удаление которого вызвало удаление фото
+	  Returns:
+	"""
+	# при удалении самого продукта изменение его фото не записывается
+	origin = kwargs.get('origin')
+	if getattr(origin, 'model', type(origin)) not in (Product, Shop):
+		log_changes(Product, (instance.product_id,), ChangeLog.UPDATE)
+
+
+post_save.connect(process_product_image_update, sender=ProductImage)
+post_delete.connect(process_product_image_update, sender=ProductImage)
+
+
+class ChangeLog(Model):
+	"""Класс записи журнала изменений (outbox) продуктов и категорий
+
+	  Attributes:
+	    model_name: название изменённой модели
+	    object_id: ID изменённого объекта
+	    action: тип изменения
+	    created: время изменения
+	"""
+	CREATE = 'create'
+	UPDATE = 'update'
+	DELETE = 'delete'
+	ACTION_CHOICES = (
+		(CREATE, 'Создание'),
+		(UPDATE, 'Изменение'),
+		(DELETE, 'Удаление'),
+	)
+
+	model_name = CharField(verbose_name='Модель', max_length=30)
+	object_id = PositiveBigIntegerField(verbose_name='ID объекта')
+	action = CharField(verbose_name='Действие', max_length=6, choices=ACTION_CHOICES)
+	created = DateTimeField(verbose_name='Время изменения', auto_now_add=True)
+
+	class Meta:
+		"""Локальный класс настроек модели
+
+		  Attributes:
+		    db_table: название таблицы модели в БД
+		    verbose_name: наименование одного объекта модели
+		    verbose_name_plural: множественное число наименования модели
+		    ordering: порядок сортировки по умолчанию
+		"""
+		db_table = 'changelog'
+		verbose_name = 'Запись журнала изменений'
+		verbose_name_plural = 'Журнал изменений'
+		ordering = ('id',)
+
+
+def log_changes(model, ids, action):
+	"""Добавляет записи об изменении объектов в журнал изменений.
+	  Должна вызываться внутри транзакции, в которой выполняется само изменение.
+
+	  Args:
+	    model: класс изменённой модели
+	    ids: ID изменённых объектов
+	    action: тип изменения (ChangeLog.CREATE, ChangeLog.UPDATE, ChangeLog.DELETE)
+	  Returns:
+	"""
+	model_name = model._meta.model_name
+	ChangeLog.objects.bulk_create(
+		ChangeLog(model_name=model_name, object_id=i, action=action) for i in set(ids) if i is not None
+	)
@@ -0,0 +1,17 @@
+"""Точка входа процессов-обработчиков сборки снимков каталога.
+
+  Модуль не импортирует модели, поэтому может быть загружен в новом процессе
+  (методы запуска spawn и forkserver) до вызова django.setup().
+"""
+import django
+
+
+def init():
+	"""Подготавливает Django в процессе-обработчике"""
+	django.setup()
+
+
+def build_shop_snapshot(shop_id, directory):
+	"""Строит снимок каталога одного магазина в процессе-обработчике"""
+	from .snapshots import build_shop_snapshot
+	return build_shop_snapshot(shop_id, directory)
@@ -0,0 +1,270 @@
+"""Сборка снимков каталога магазинов для витрины.
+
+  Снимок магазина хранится в одном файле <shop_id>.snapshot:
+    заголовок HEADER: метка формата и количество продуктов
+    индекс из записей INDEX_RECORD (ID продукта, смещение, длина), отсортированных
+      по ID продукта; смещение отсчитывается от начала записей
+    записи продуктов, каждая сжата zlib отдельно и записана подряд
+
+  Файл заменяется целиком одним os.replace, поэтому читатель всегда видит индекс
+  и записи одной сборки. Файл можно отобразить в память (mmap) и читать запись
+  продукта по смещению, не распаковывая весь снимок. В manifest.json хранится
+  курсор журнала изменений, по которому строился последний снимок.
+"""
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from django.db import connections
+from django.db.models import Max, Prefetch
+from django.utils import timezone
+from . import snapshot_worker
+from .models import Shop, Category, CategoryParent, Product, ProductImage, ChangeLog
+
+HEADER = struct.Struct('<4sQ')
+SNAPSHOT_MAGIC = b'CSN1'
+INDEX_RECORD = struct.Struct('<QQI')
+MANIFEST_NAME = 'manifest.json'
+PAGE_SIZE = 500
+
+
+def category_path_titles(category, cache):
+	"""Возвращает список полных путей к категории
+
+	  Args:
+	    category: объект категории
+	    cache: словарь уже вычисленных путей по ID категории
+	  Returns:
+	  	list: список строк путей, включая название самой категории
+	"""
+	if category.pk not in cache:
+		cache[category.pk] = [p+category.title for p in category.get_all_paths()] or [category.title]
+	return cache[category.pk]
+
+
+def build_shop_snapshot(shop_id, directory):
+	"""Строит снимок каталога одного магазина
+
+	  Args:
+	    shop_id: ID магазина
+	    directory: каталог для файлов снимка
+	  Returns:
+	  	tuple: ID магазина и количество продуктов в снимке
+	"""
+	directory = Path(directory)
+	products = (Product.objects.filter(shop_id=shop_id, active=True)
+		.only('id', 'title', 'description', 'price', 'amount')
+		.prefetch_related(
+			Prefetch('categories', queryset=Category.objects.only('title')),
+			Prefetch('images', queryset=ProductImage.objects.only('image', 'product_id').order_by('id')),
+		)
+		.order_by('id'))
+	cache = {}
+	index = []
+	path = snapshot_path(directory, shop_id)
+	# записи копятся во временном файле: количество продуктов известно только в конце
+	with tempfile.TemporaryFile(dir=directory) as data:
+		offset = 0
+		for product in iterate_pages(products):
+			record = {
+				'id': product.id,
+				'title': product.title,
+				'description': product.description,
+				'price': str(product.price),
+				'amount': product.amount,
+				'categories': sorted(p for c in product.categories.all() for p in category_path_titles(c, cache)),
+				'images': [i.image.url for i in product.images.all()],
+			}
+			chunk = zlib.compress(json.dumps(record, ensure_ascii=False).encode())
+			data.write(chunk)
+			index.append(INDEX_RECORD.pack(product.id, offset, len(chunk)))
+			offset += len(chunk)
+		data.seek(0)
+		with open(f'{path}.tmp', 'wb') as f:
+			f.write(HEADER.pack(SNAPSHOT_MAGIC, len(index)))
+			f.write(b''.join(index))
+			shutil.copyfileobj(data, f)
+	os.replace(f'{path}.tmp', path)
+	return shop_id, len(index)
+
+
+def snapshot_path(directory, shop_id):
+	"""Возвращает путь к файлу снимка магазина"""
+	return Path(directory) / f'{shop_id}.snapshot'
+
+
+def read_header(buffer):
+	"""Разбирает заголовок снимка
+
+	  Args:
+	    buffer: начало файла снимка
+	  Returns:
+	  	int: количество продуктов в снимке
+	"""
+	magic, count = HEADER.unpack_from(buffer)
+	if magic != SNAPSHOT_MAGIC:
+		raise ValueError('Неизвестный формат снимка каталога')
+	return count
+
+
+def iterate_pages(queryset):
+	"""Перебирает объекты упорядоченного по ID набора страницами по PAGE_SIZE.
+	  В отличие от iterator() сохраняет prefetch_related в любой версии Django.
+
+	  Args:
+	    queryset: набор объектов, упорядоченный по ID
+	  Returns:
+	"""
+	last = 0
+	while True:
+		page = list(queryset.filter(id__gt=last)[:PAGE_SIZE])
+		yield from page
+		if len(page) < PAGE_SIZE:
+			return
+		last = page[-1].id
+
+
+class IndexView:
+	"""Последовательность записей индекса снимка поверх буфера (например, mmap)"""
+
+	def __init__(self, buffer, count, start=HEADER.size):
+		self.buffer = buffer
+		self.count = count
+		self.start = start
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		if not 0 <= i < len(self):
+			raise IndexError(i)
+		return INDEX_RECORD.unpack_from(self.buffer, self.start+i*INDEX_RECORD.size)
+
+
+def read_index(path):
+	"""Читает индекс снимка магазина, не читая записи продуктов
+
+	  Args:
+	    path: путь к файлу снимка
+	  Returns:
+	  	list: кортежи (ID продукта, смещение, длина)
+	"""
+	with open(path, 'rb') as f:
+		count = read_header(f.read(HEADER.size))
+		return list(INDEX_RECORD.iter_unpack(f.read(count*INDEX_RECORD.size)))
+
+
+def load_product(directory, shop_id, product_id):
+	"""Читает запись продукта из снимка магазина через mmap
+
+	  Args:
+	    directory: каталог снимков
+	    shop_id: ID магазина
+	    product_id: ID продукта
+	  Returns:
+	  	dict: запись продукта или None, если продукта нет в снимке
+	"""
+	with open(snapshot_path(directory, shop_id), 'rb') as f, \
+			mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+		index = IndexView(m, read_header(m))
+		i = bisect.bisect_left(index, (product_id,))
+		if i == len(index) or index[i][0] != product_id:
+			return None
+		_, offset, length = index[i]
+		offset += HEADER.size+len(index)*INDEX_RECORD.size
+		return json.loads(zlib.decompress(m[offset:offset+length]))
+
+
+def load_manifest(directory):
+	"""Читает манифест снимков или возвращает None, если снимков ещё нет"""
+	try:
+		with open(Path(directory) / MANIFEST_NAME, encoding='utf-8') as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return None
+
+
+def changed_shop_ids(directory, manifest):
+	"""Определяет магазины, каталог которых изменился после последнего снимка
+
+	  Args:
+	    directory: каталог снимков
+	    manifest: манифест последнего снимка
+	  Returns:
+	  	set: ID магазинов или None, если нужно пересобрать все магазины
+	"""
+	changes = ChangeLog.objects.filter(id__gt=manifest['cursor'])
+	categories = changes.filter(model_name=Category._meta.model_name)
+	if categories.filter(action=ChangeLog.DELETE).exists():
+		return None
+	shop_ids = set(Product.objects.filter(
+		id__in=changes.filter(model_name=Product._meta.model_name).values('object_id')
+		).values_list('shop_id', flat=True))
+	# изменение категории меняет пути ко всем её потомкам
+	category_ids = set(categories.values_list('object_id', flat=True))
+	frontier = set(category_ids)
+	while frontier:
+		frontier = set(CategoryParent.objects.filter(to_category_id__in=frontier)
+			.values_list('from_category_id', flat=True)) - category_ids
+		category_ids |= frontier
+	if category_ids:
+		shop_ids |= set(Product.objects.filter(categories__id__in=category_ids)
+			.values_list('shop_id', flat=True))
+	# удалённые и перенесённые в другой магазин продукты ищем в индексах прежних снимков
+	product_ids = set(changes.filter(model_name=Product._meta.model_name)
+		.values_list('object_id', flat=True))
+	if product_ids:
+		for shop_id in manifest['shops']:
+			path = snapshot_path(directory, shop_id)
+			if path.exists() and any(r[0] in product_ids for r in read_index(path)):
+				shop_ids.add(int(shop_id))
+	return shop_ids
+
+
+def build_snapshots(directory, full=False, workers=None):
+	"""Строит снимки каталогов магазинов, пересобирая только изменившиеся
+
+	  Args:
+	    directory: каталог снимков
+	    full: пересобрать снимки всех магазинов
+	    workers: количество процессов
+	  Returns:
+	  	dict: количество продуктов в пересобранных снимках по ID магазина
+	"""
+	directory = Path(directory)
+	directory.mkdir(parents=True, exist_ok=True)
+	cursor = ChangeLog.objects.aggregate(cursor=Max('id'))['cursor'] or 0
+	manifest = None if full else load_manifest(directory)
+	all_ids = set(Shop.objects.values_list('id', flat=True))
+	if manifest is None:
+		manifest = {'shops': {}}
+		shop_ids = all_ids
+	else:
+		shop_ids = changed_shop_ids(directory, manifest)
+		shop_ids = all_ids if shop_ids is None else shop_ids & all_ids
+		shop_ids |= all_ids - {int(i) for i in manifest['shops']}
+	# соединения с БД не должны наследоваться процессами-обработчиками
+	connections.close_all()
+	built = {}
+	if shop_ids:
+		with ProcessPoolExecutor(max_workers=workers, initializer=snapshot_worker.init) as pool:
+			for shop_id, count in pool.map(snapshot_worker.build_shop_snapshot, sorted(shop_ids),
+					[directory]*len(shop_ids)):
+				built[shop_id] = count
+	for shop_id in set(manifest['shops']) - {str(i) for i in all_ids}:
+		del manifest['shops'][shop_id]
+		snapshot_path(directory, shop_id).unlink(missing_ok=True)
+	built_at = timezone.now().isoformat()
+	for shop_id, count in built.items():
+		manifest['shops'][str(shop_id)] = {'products': count, 'built': built_at}
+	manifest['cursor'] = cursor
+	with open(directory / f'{MANIFEST_NAME}.tmp', 'w', encoding='utf-8') as f:
+		json.dump(manifest, f, ensure_ascii=False, indent=1)
+	os.replace(directory / f'{MANIFEST_NAME}.tmp', directory / MANIFEST_NAME)
+	return built
@@ -0,0 +1,70 @@
+import hashlib
+from django import template
+from django.conf import settings
+from django.contrib.admin.templatetags.admin_list import (
+	ResultList, items_for_result, result_headers, result_hidden_fields, results)
+from django.contrib.admin.templatetags.base import InclusionAdminNode
+from django.core.cache import cache
+from django.utils.translation import get_language
+
+register = template.Library()
+
+
+def row_cache_key(cl, obj):
+	"""Возвращает ключ кеша строки списка объектов
+
+	  Args:
+	    cl: список объектов (ChangeList)
+	    obj: объект строки
+	  Returns:
+	  	str: ключ кеша
+	"""
+	params = (cl.list_display, cl.list_display_links, cl.preserved_filters, get_language(),
+		cl.model_admin.get_row_version(obj))
+	return f'changelist-row:{cl.opts.label_lower}:{obj.pk}:{hashlib.md5(repr(params).encode()).hexdigest()}'
+
+
+def cached_results(cl):
+	"""Возвращает строки списка объектов, отрисовывая только отсутствующие в кеше
+
+	  Args:
+	    cl: список объектов (ChangeList)
+	  Returns:
+	  	list: строки списка (ResultList)
+	"""
+	if cl.formset or not settings.CHANGELIST_ROW_CACHE:
+		return list(results(cl))
+	keys = [row_cache_key(cl, obj) for obj in cl.result_list]
+	cached = cache.get_many(keys)
+	missing = {}
+	rows = []
+	for key, obj in zip(keys, cl.result_list):
+		items = cached.get(key)
+		if items is None:
+			items = missing[key] = list(items_for_result(cl, obj, None))
+		rows.append(ResultList(None, items))
+	cache.set_many(missing, cl.model_admin.row_cache_timeout)
+	cl.row_cache_hits = len(cached)
+	return rows
+
+
+def cached_result_list(cl):
+	"""Формирует контекст таблицы списка объектов так же, как тег result_list"""
+	headers = list(result_headers(cl))
+	return {
+		'cl': cl,
+		'result_hidden_fields': list(result_hidden_fields(cl)),
+		'result_headers': headers,
+		'num_sorted_fields': sum(1 for h in headers if h['sortable'] and h['sorted']),
+		'results': cached_results(cl),
+	}
+
+
+@register.tag(name='cached_result_list')
+def cached_result_list_tag(parser, token):
+	return InclusionAdminNode(
+		parser, token,
+		func=cached_result_list,
+		template_name='change_list_results.html',
+		takes_context=False,
+	)
@@ -1,3 +1,387 @@
-from django.test import TestCase
+import hashlib
+import json
+import tempfile
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+from PIL import Image as PILImage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.template.defaultfilters import truncatechars
+from django.urls import reverse
+from .models import (Shop, Category, CategoryParent, Product, ProductImage, ChangeLog,
+	ConcurrentEditError, check_category_graph, claim_versions, read_image_metadata)
+from .admin import CategoryAdminForm
+from . import snapshots
 
 # Create your tests here.
+
+def image_file(name='photo.png', size=(40, 30), image_format='PNG'):
+	"""Возвращает загружаемый файл изображения заданного размера и формата"""
+	buffer = BytesIO()
+	PILImage.new('RGB', size, 'red').save(buffer, image_format)
+	return SimpleUploadedFile(name, buffer.getvalue())
+
+
+def changed(model, action=ChangeLog.UPDATE):
+	"""Возвращает множество ID объектов модели, записанных в журнал изменений"""
+	return set(ChangeLog.objects.filter(model_name=model._meta.model_name, action=action)
+		.values_list('object_id', flat=True))
+
+
+class ChangeLogTests(TestCase):
+	def setUp(self):
+		self.shop = Shop.objects.create(title='Shop')
+		self.root = Category.objects.create(title='Root')
+		self.child = Category.objects.create(title='Child')
+		CategoryParent.objects.create(from_category=self.child, to_category=self.root)
+		self.product = Product.objects.create(shop=self.shop, title='Product', price=1)
+		self.product.categories.add(self.root)
+		ChangeLog.objects.all().delete()
+
+	def test_parents_set_logs_both_categories(self):
+		other = Category.objects.create(title='Other')
+		ChangeLog.objects.all().delete()
+		self.child.parents.set([other])
+		self.assertEqual(changed(Category), {self.child.pk, self.root.pk, other.pk})
+
+	def test_form_save_logs_category(self):
+		form = CategoryAdminForm({'title': 'New', 'loaded_version': ''})
+		self.assertTrue(form.is_valid(), form.errors)
+		category = form.save()
+		self.assertEqual(changed(Category, ChangeLog.CREATE), {category.pk})
+
+	def test_category_delete_logs_children_and_products(self):
+		root_id = self.root.pk
+		self.root.delete()
+		self.assertEqual(changed(Category, ChangeLog.DELETE), {root_id})
+		self.assertEqual(changed(Category), {self.child.pk})
+		self.assertEqual(changed(Product), {self.product.pk})
+
+	def test_shop_delete_logs_products(self):
+		product_id = self.product.pk
+		self.shop.delete()
+		self.assertEqual(changed(Product, ChangeLog.DELETE), {product_id})
+		self.assertEqual(changed(Product), set())
+
+	def test_make_inactive_logs_only_changed_products(self):
+		inactive = Product.objects.create(shop=self.shop, title='Inactive', price=1, active=False)
+		ChangeLog.objects.all().delete()
+		model_admin = admin.site._registry[Product]
+		model_admin.make_inactive(None, Product.objects.all())
+		self.assertEqual(changed(Product), {self.product.pk})
+		self.assertFalse(Product.objects.filter(active=True).exists())
+		self.assertNotIn(inactive.pk, changed(Product))
+
+	def test_exportchanges_streams_after_cursor(self):
+		ids = [ChangeLog.objects.create(model_name='product', object_id=i, action=ChangeLog.UPDATE).pk
+			for i in range(5)]
+		out = StringIO()
+		call_command('exportchanges', cursor=ids[1], batch_size=2, stdout=out, stderr=StringIO())
+		records = [json.loads(line) for line in out.getvalue().splitlines()]
+		self.assertEqual([r['id'] for r in records], ids[2:])
+		self.assertEqual(records[0]['model_name'], 'product')
+
+
+class SnapshotTests(TestCase):
+	def setUp(self):
+		media = tempfile.TemporaryDirectory()
+		self.addCleanup(media.cleanup)
+		self.enterContext(override_settings(MEDIA_ROOT=media.name))
+		output = tempfile.TemporaryDirectory()
+		self.addCleanup(output.cleanup)
+		self.directory = Path(output.name)
+		self.shop = Shop.objects.create(title='Shop')
+		self.other_shop = Shop.objects.create(title='Other shop', imageUrl=image_file())
+		self.root = Category.objects.create(title='Root')
+		self.child = Category.objects.create(title='Child')
+		CategoryParent.objects.create(from_category=self.child, to_category=self.root)
+		self.products = [Product.objects.create(shop=self.shop, title=f'Product {i}', price=i) for i in range(3)]
+		self.products[1].categories.add(self.child)
+		ProductImage.objects.create(product=self.products[1], image=image_file())
+		Product.objects.create(shop=self.shop, title='Inactive', price=1, active=False)
+
+	def test_snapshot_round_trip(self):
+		self.assertEqual(snapshots.build_shop_snapshot(self.shop.pk, self.directory), (self.shop.pk, 3))
+		record = snapshots.load_product(self.directory, self.shop.pk, self.products[1].pk)
+		self.assertEqual(record['title'], 'Product 1')
+		self.assertEqual(record['categories'], ['Root / Child'])
+		self.assertEqual(len(record['images']), 1)
+		self.assertIsNone(snapshots.load_product(self.directory, self.shop.pk, 10**6))
+
+	def test_index_format(self):
+		snapshots.build_shop_snapshot(self.shop.pk, self.directory)
+		path = self.directory / f'{self.shop.pk}.snapshot'
+		index = snapshots.read_index(path)
+		self.assertEqual([r[0] for r in index], [p.pk for p in self.products])
+		offset = 0
+		for _, start, length in index:
+			self.assertEqual(start, offset)
+			offset += length
+		header = snapshots.HEADER.size+len(index)*snapshots.INDEX_RECORD.size
+		self.assertEqual(header+offset, path.stat().st_size)
+
+	def test_rebuild_replaces_single_file(self):
+		snapshots.build_shop_snapshot(self.shop.pk, self.directory)
+		Product.objects.filter(pk=self.products[0].pk).update(title='Renamed')
+		snapshots.build_shop_snapshot(self.shop.pk, self.directory)
+		self.assertEqual([p.name for p in self.directory.iterdir()], [f'{self.shop.pk}.snapshot'])
+		self.assertEqual(snapshots.load_product(self.directory, self.shop.pk, self.products[0].pk)['title'],
+			'Renamed')
+
+	def test_empty_shop_snapshot(self):
+		snapshots.build_shop_snapshot(self.other_shop.pk, self.directory)
+		self.assertIsNone(snapshots.load_product(self.directory, self.other_shop.pk, self.products[0].pk))
+
+	def changed_after_snapshot(self, change):
+		for shop in (self.shop, self.other_shop):
+			snapshots.build_shop_snapshot(shop.pk, self.directory)
+		manifest = {'cursor': ChangeLog.objects.order_by('-id').values_list('id', flat=True).first() or 0,
+			'shops': {str(self.shop.pk): {}, str(self.other_shop.pk): {}}}
+		change()
+		return snapshots.changed_shop_ids(self.directory, manifest)
+
+	def test_moved_product_rebuilds_both_shops(self):
+		def move():
+			product = self.products[0]
+			product.shop = self.other_shop
+			product.save()
+			ChangeLog.objects.create(model_name='product', object_id=product.pk, action=ChangeLog.UPDATE)
+		self.assertEqual(self.changed_after_snapshot(move), {self.shop.pk, self.other_shop.pk})
+
+	def test_parent_category_change_rebuilds_descendant_shops(self):
+		rename = lambda: self.root.parents.add(Category.objects.create(title='Top'))
+		self.assertEqual(self.changed_after_snapshot(rename), {self.shop.pk})
+
+	def test_image_change_rebuilds_shop(self):
+		add = lambda: ProductImage.objects.create(product=self.products[0], image=image_file())
+		self.assertEqual(self.changed_after_snapshot(add), {self.shop.pk})
+
+
+class CategoryConcurrencyTests(TestCase):
+	def setUp(self):
+		self.a, self.b, self.c = (Category.objects.create(title=t) for t in ('Aaa', 'Bbb', 'Ccc'))
+		CategoryParent.objects.create(from_category=self.b, to_category=self.a)
+
+	def form(self, category, parents=(), children=()):
+		category.refresh_from_db()
+		return CategoryAdminForm({'title': category.title, 'loaded_version': category.version,
+			'parents': [c.pk for c in parents], 'children': [c.pk for c in children]}, instance=category)
+
+	def test_check_category_graph(self):
+		check_category_graph(self.c.pk, [self.b.pk], [])
+		check_category_graph(None, [self.a.pk], [self.c.pk])
+		with self.assertRaises(ValidationError):
+			check_category_graph(self.a.pk, [self.b.pk], [self.b.pk])
+		d = Category.objects.create(title='Ddd')
+		CategoryParent.objects.create(from_category=d, to_category=self.b)
+		with self.assertRaises(ValidationError):
+			check_category_graph(self.a.pk, [d.pk], [self.b.pk])
+		with self.assertRaises(ValidationError):
+			check_category_graph(self.c.pk, [self.b.pk], [self.a.pk])
+		with self.assertRaises(ValidationError):
+			check_category_graph(self.c.pk, [self.a.pk], [self.a.pk])
+
+	def test_claim_versions(self):
+		claim_versions(Category, {self.a.pk: 0, self.c.pk: 0})
+		self.assertEqual(Category.objects.get(pk=self.a.pk).version, 1)
+		with self.assertRaises(ConcurrentEditError):
+			claim_versions(Category, {self.a.pk: 0})
+		claim_versions(Category, {self.b.pk: 0}, locked_ids=[self.a.pk, self.c.pk])
+		self.assertEqual(Category.objects.get(pk=self.c.pk).version, 1)
+		self.assertEqual(Category.objects.get(pk=self.b.pk).version, 1)
+
+	def test_cycle_form_is_rejected(self):
+		form = self.form(self.a, parents=[self.b])
+		self.assertFalse(form.is_valid())
+		self.assertIn('parents', form.errors)
+
+	def test_concurrent_edges_cannot_form_cycle(self):
+		first = self.form(self.a, parents=[self.c])
+		second = self.form(self.c, parents=[self.b])
+		self.assertTrue(first.is_valid(), first.errors)
+		self.assertTrue(second.is_valid(), second.errors)
+		first.save()
+		second.save()
+		self.assertTrue(second.errors)
+		self.assertFalse(CategoryParent.objects.filter(from_category=self.c, to_category=self.b).exists())
+
+	def test_concurrent_edge_change_is_not_overwritten(self):
+		first = self.form(self.a, parents=[self.c])
+		second = self.form(self.c, children=[self.b])
+		self.assertTrue(first.is_valid(), first.errors)
+		self.assertTrue(second.is_valid(), second.errors)
+		first.save()
+		# связанные категории блокируются, но их версии не меняются
+		self.assertEqual(Category.objects.get(pk=self.c.pk).version, 0)
+		second.save()
+		self.assertTrue(second.errors)
+		self.assertTrue(CategoryParent.objects.filter(from_category=self.a, to_category=self.c).exists())
+
+	def test_stale_version_is_rejected(self):
+		form = self.form(self.c)
+		Category.objects.filter(pk=self.c.pk).update(version=5)
+		form.instance.version = 5
+		self.assertFalse(form.is_valid())
+		self.assertTrue(form.non_field_errors())
+
+	def test_admin_change_view(self):
+		self.client.force_login(User.objects.create_superuser('admin', password='admin'))
+		url = reverse('admin:core_category_change', args=[self.c.pk])
+		data = {'title': 'Ccc', 'description': '', 'loaded_version': 0, 'parents': [self.b.pk]}
+		self.assertEqual(self.client.post(url, data).status_code, 302)
+		self.c.refresh_from_db()
+		self.assertEqual(self.c.version, 1)
+		self.assertEqual(list(self.c.parents.all()), [self.b])
+		response = self.client.post(url, data)
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(response.context['adminform'].form.non_field_errors())
+
+	def test_product_admin_change_view(self):
+		self.client.force_login(User.objects.create_superuser('admin', password='admin'))
+		product = Product.objects.create(shop=Shop.objects.create(title='Shop'), title='Product', price=1)
+		url = reverse('admin:core_product_change', args=[product.pk])
+		self.assertEqual(self.client.get(url).status_code, 200)
+		data = {'shop': product.shop_id, 'title': 'Renamed', 'active': 'on', 'amount': 1, 'price': 2,
+			'loaded_version': 0}
+		self.assertEqual(self.client.post(url, data).status_code, 302)
+		product.refresh_from_db()
+		self.assertEqual((product.title, product.version), ('Renamed', 1))
+		self.assertEqual(self.client.post(url, data).status_code, 200)
+
+
+class ImageMetadataTests(TestCase):
+	def setUp(self):
+		media = tempfile.TemporaryDirectory()
+		self.addCleanup(media.cleanup)
+		self.enterContext(override_settings(MEDIA_ROOT=media.name))
+		self.product = Product.objects.create(shop=Shop.objects.create(title='Shop'), title='Product', price=1)
+
+	def test_read_image_metadata(self):
+		file = image_file(size=(64, 48), image_format='JPEG')
+		metadata = read_image_metadata(file)
+		self.assertEqual((metadata['image_width'], metadata['image_height']), (64, 48))
+		self.assertEqual(metadata['image_format'], 'JPEG')
+		self.assertEqual(metadata['image_size'], file.size)
+		self.assertEqual(metadata['image_hash'], hashlib.sha256(file.read()).hexdigest())
+
+	def test_metadata_filled_on_upload(self):
+		image = ProductImage.objects.create(product=self.product, image=image_file(size=(10, 20)))
+		self.assertEqual((image.image_width, image.image_height, image.image_format), (10, 20, 'PNG'))
+
+	def test_scanimages_backfills_and_skips_broken_files(self):
+		good = ProductImage.objects.create(product=self.product, image=image_file())
+		broken = ProductImage.objects.create(product=self.product, image=image_file())
+		ProductImage.objects.update(image_width=None, image_height=None, image_size=None,
+			image_format=None, image_hash=None)
+		with open(broken.image.path, 'wb') as f:
+			f.write(b'not an image')
+		out = StringIO()
+		call_command('scanimages', stdout=out, stderr=StringIO())
+		good.refresh_from_db()
+		broken.refresh_from_db()
+		self.assertEqual(good.image_width, 40)
+		self.assertIsNone(broken.image_hash)
+		self.assertIn('обработано 1, ошибок 1', out.getvalue())
+
+	def test_scanimages_survives_decompression_bomb(self):
+		image = ProductImage.objects.create(product=self.product, image=image_file())
+		ProductImage.objects.update(image_hash=None)
+		with mock.patch.object(PILImage, 'MAX_IMAGE_PIXELS', 10):
+			call_command('scanimages', stdout=StringIO(), stderr=StringIO())
+		image.refresh_from_db()
+		self.assertIsNone(image.image_hash)
+
+
+	def test_product_actions_with_image_filters(self):
+		self.client.force_login(User.objects.create_superuser('admin', password='admin'))
+		url = reverse('admin:core_product_changelist')
+		# значения метаданных фото продукта, попадающего под фильтр; None - продукт без фото
+		cases = (('main_image=missing', None), ('main_image=small', {}),
+			('main_image=unscanned', {'image_width': None, 'image_height': None}),
+			('image_size=1', {'image_size': 2*1024*1024}))
+		for query, values in cases:
+			with self.subTest(query=query):
+				product = Product.objects.create(shop=self.product.shop, title=f'Product {query}', price=1)
+				if values is not None:
+					ProductImage.objects.create(product=product, image=image_file())
+					ProductImage.objects.filter(product=product).update(**values)
+				self.assertContains(self.client.get(f'{url}?{query}'), f'Product {query}')
+				for data in ({'action': 'make_inactive'}, {'action': 'delete_selected', 'post': 'yes'}):
+					data['_selected_action'] = [product.pk]
+					self.assertEqual(self.client.post(f'{url}?{query}', data).status_code, 302)
+				self.assertFalse(Product.objects.filter(pk=product.pk).exists())
+				self.assertIn(product.pk, changed(Product, ChangeLog.DELETE))
+		self.assertTrue(Product.objects.filter(pk=self.product.pk).exists())
+
+
+class ChangelistTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.client.force_login(User.objects.create_superuser('admin', password='admin'))
+		self.shop = Shop.objects.create(title='Shop', description='x'*500)
+
+	def test_substr_matches_truncatechars(self):
+		model_admin = admin.site._registry[Shop]
+		length = model_admin.short_description_length
+		for size in (0, 1, length-1, length, length+1, length+2, 500):
+			Shop.objects.filter(pk=self.shop.pk).update(description='ф'*size)
+			shop = model_admin.with_short_description(Shop.objects.filter(pk=self.shop.pk)).get()
+			self.assertEqual(model_admin.short_description(shop), truncatechars('ф'*size, length))
+
+	def result_table(self, response):
+		content = response.content.decode()
+		start = content.index('<table id="result_list">')
+		return content[start:content.index('</table>', start)]
+
+	def test_cached_rows_match_uncached(self):
+		url = reverse('admin:core_shop_changelist')
+		with override_settings(CHANGELIST_ROW_CACHE=False):
+			uncached = self.result_table(self.client.get(url))
+		self.assertEqual(self.result_table(self.client.get(url)), uncached)
+		response = self.client.get(url)
+		self.assertEqual(self.result_table(response), uncached)
+		self.assertEqual(response.context['cl'].row_cache_hits, 1)
+
+	def test_changed_row_is_rendered_again(self):
+		url = reverse('admin:core_shop_changelist')
+		self.client.get(url)
+		Shop.objects.filter(pk=self.shop.pk).update(title='Renamed shop')
+		response = self.client.get(url)
+		self.assertContains(response, 'Renamed shop')
+		self.assertEqual(response.context['cl'].row_cache_hits, 0)
+
+	def test_product_changelist_rows(self):
+		media = tempfile.TemporaryDirectory()
+		self.addCleanup(media.cleanup)
+		self.enterContext(override_settings(MEDIA_ROOT=media.name))
+		products = [Product.objects.create(shop=self.shop, title=f'Product {i}', price=i, description='x'*100)
+			for i in range(3)]
+		image = ProductImage.objects.create(product=products[0], image=image_file())
+		url = reverse('admin:core_product_changelist')+'?active__exact=1&main_image=small'
+		with override_settings(CHANGELIST_ROW_CACHE=False):
+			uncached = self.result_table(self.client.get(url))
+		response = self.client.get(url)
+		self.assertEqual(self.result_table(response), uncached)
+		self.assertIn(f'{settings.MEDIA_URL}{image.image.name}', uncached)
+		cl = response.context['cl']
+		self.assertEqual([p.pk for p in cl.result_list], [products[0].pk])
+		self.assertEqual(cl.result_list[0].main_image_name, image.image.name)
+		self.assertIn('description', cl.result_list[0].get_deferred_fields())
+		self.assertEqual(self.client.get(url).context['cl'].row_cache_hits, 1)
+		# изменение версии без изменения отображаемых полей отрисовывает строку заново
+		Product.objects.filter(pk=products[0].pk).update(version=F('version')+1)
+		self.assertEqual(self.client.get(url).context['cl'].row_cache_hits, 0)
+		response = self.client.post(url, {'action': 'make_inactive', '_selected_action': [products[0].pk]})
+		self.assertEqual(response.status_code, 302)
+		products[0].refresh_from_db()
+		self.assertEqual((products[0].active, products[0].version), (False, 2))
+		self.assertEqual(changed(Product), {products[0].pk})
+		self.assertEqual(list(self.client.get(url).context['cl'].result_list), [])
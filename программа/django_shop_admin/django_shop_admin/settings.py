@@ -37,6 +37,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'admin_numeric_filter',
+    'core',
 ]
 
 MIDDLEWARE = [
@@ -119,6 +121,23 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+STATICFILES_DIRS = [BASE_DIR / 'static']
+
+MEDIA_URL = '/media/'
+
+MEDIA_ROOT = BASE_DIR / 'media'
+
+IMAGES_DIR = 'images'
+
+# Catalog snapshots for the storefront (manage.py buildsnapshots)
+
+CATALOG_SNAPSHOTS_DIR = BASE_DIR / 'snapshots'
+
+# Cache rendered changelist rows of ProductAdmin and ShopAdmin.
+# Disable to compare the CPU time logged by core.admin per changelist page.
+
+CHANGELIST_ROW_CACHE = True
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 